@@ -1,6 +1,7 @@
-use std::{collections::HashMap, io};
+use std::{collections::HashMap, sync::Arc, time::Duration};
 
-use crossterm::event::{self, Event, KeyCode, KeyEvent, KeyEventKind};
+use crossterm::event::{Event, EventStream, KeyCode, KeyEvent, KeyEventKind};
+use futures::StreamExt;
 use ratatui::{
     buffer::Buffer,
     layout::Rect,
@@ -9,15 +10,32 @@ use ratatui::{
     widgets::{block::*, *},
     Frame,
 };
+use serde::Deserialize;
+use serde_json::Value;
+use simple_log::warn;
+use tokio::sync::watch;
 
 use crate::{
     handle_incoming_call, handle_sending_call, peer_connection::PeerConnection, rtdb::RTDB,
     schemas::user::User, tui,
 };
 
+// Pause before resubscribing to the users after the stream was dropped
+const CONTACTS_RESUBSCRIBE_DELAY: Duration = Duration::from_millis(500);
+// How long the first users snapshot may take to stream in before they are fetched directly
+const CONTACTS_FALLBACK_DELAY: Duration = Duration::from_millis(300);
+
+enum Call {
+    Incoming(User),
+    Outgoing(String),
+}
+
 #[derive(Debug, Default)]
 pub struct App {
     contacts: HashMap<String, User>,
+    // Sorted names of everyone but us, rebuilt only when the contacts change rather than on
+    // every draw
+    peer_names: Vec<String>,
     selected: usize,
     exit: bool,
     name: String,
@@ -26,39 +44,70 @@ pub struct App {
 
 impl App {
     /// runs the application's main loop until the user quits
-    pub async fn run(&mut self, terminal: &mut tui::Tui, self_name: &str) -> anyhow::Result<()> {
-        let mut begin = std::time::Instant::now();
+    pub async fn run(
+        &mut self,
+        terminal: &mut tui::Tui,
+        self_name: &str,
+        rtdb: Arc<RTDB>,
+    ) -> anyhow::Result<()> {
         self.name = self_name.to_owned();
 
         let rtc_connection = PeerConnection::new().await?;
-        let rtdb = RTDB::new();
-        self.update_contacts(&rtdb).await;
+        let mut contacts = spawn_contacts_listener(rtdb.clone());
 
-        while !self.exit {
+        // Keys are read as the terminal delivers them, and the loop otherwise sleeps until the
+        // contacts change, so neither waits on a polling interval
+        let mut events = EventStream::new();
+        let call = loop {
             terminal.draw(|frame| self.render_frame(frame))?;
-            self.handle_events()?;
 
-            if begin.elapsed().as_millis() > 1000 {
-                self.update_contacts(&rtdb).await;
-                begin = std::time::Instant::now();
+            tokio::select! {
+                event = events.next() => match event {
+                    Some(Ok(Event::Key(key_event))) if key_event.kind == KeyEventKind::Press => {
+                        self.handle_key_event(key_event)
+                    }
+                    Some(Ok(_)) => {}
+                    Some(Err(e)) => return Err(e.into()),
+                    None => self.exit(),
+                },
+                Ok(()) = contacts.changed() => {
+                    let users = contacts.borrow_and_update().clone();
+                    self.update_contacts(users);
+                }
             }
 
             // Check if anyone is calling us (someone else's sending_call is our name)
             let potential_caller = self
                 .contacts
-                .iter()
-                .find(|(_k, v)| v.sending_call == self_name);
+                .values()
+                .find(|user| user.sending_call == self_name);
 
-            if let Some((_, caller_data)) = potential_caller {
-                handle_incoming_call(&self_name, caller_data, &rtdb, &rtc_connection).await?;
-                self.exit();
+            if let Some(caller_data) = potential_caller {
+                break Some(Call::Incoming(caller_data.clone()));
             }
-
             if self.send_call {
-                let selected_name = self.contact_names(false)[self.selected].clone();
-                handle_sending_call(&self_name, &selected_name, &rtdb, &rtc_connection).await?;
-                self.exit();
+                let selected_name = self.peer_names[self.selected].clone();
+                break Some(Call::Outgoing(selected_name));
+            }
+            if self.exit {
+                break None;
+            }
+        };
+
+        // While waiting for input the stream holds the terminal's event reader, which the
+        // call screen reads from directly. The contacts aren't needed during the call either,
+        // and streaming them would re-read every user's signaling data as it changes.
+        drop(events);
+        drop(contacts);
+
+        match call {
+            Some(Call::Incoming(caller_data)) => {
+                handle_incoming_call(&self_name, &caller_data, &rtdb, &rtc_connection).await?
             }
+            Some(Call::Outgoing(selected_name)) => {
+                handle_sending_call(&self_name, &selected_name, &rtdb, &rtc_connection).await?
+            }
+            None => {}
         }
 
         rtdb.remove_user(self_name).await;
@@ -70,41 +119,32 @@ impl App {
         frame.render_widget(self, frame.size());
     }
 
-    async fn update_contacts(&mut self, rtdb: &RTDB) {
-        self.contacts = rtdb.get_users().await;
-        if self.selected >= self.contacts.len() {
-            self.selected = self.contacts.len().saturating_sub(1);
-        }
-    }
+    fn update_contacts(&mut self, users: HashMap<String, User>) {
+        self.contacts = users;
 
-    fn contact_names(&self, include_self: bool) -> Vec<String> {
-        let mut list = self.contacts.keys().cloned().collect::<Vec<String>>();
-        list.sort();
-        if !include_self {
-            list.retain(|name| name != &self.name);
-        }
-        list
-    }
+        self.peer_names.clear();
+        self.peer_names.extend(
+            self.contacts
+                .keys()
+                .filter(|name| **name != self.name)
+                .cloned(),
+        );
+        self.peer_names.sort();
 
-    fn handle_events(&mut self) -> io::Result<()> {
-        if event::poll(std::time::Duration::from_millis(100))? {
-            match event::read()? {
-                Event::Key(key_event) if key_event.kind == KeyEventKind::Press => {
-                    self.handle_key_event(key_event)
-                }
-                _ => {}
-            }
-        };
-        Ok(())
+        if self.selected >= self.peer_names.len() {
+            self.selected = self.peer_names.len().saturating_sub(1);
+        }
     }
 
     fn handle_key_event(&mut self, key_event: KeyEvent) {
         match key_event.code {
             KeyCode::Esc => self.exit = true,
             KeyCode::Up => self.selected = self.selected.saturating_sub(1),
-            KeyCode::Down => self.selected = (self.selected + 1).min(self.contacts.len() - 2),
+            KeyCode::Down => {
+                self.selected = (self.selected + 1).min(self.peer_names.len().saturating_sub(1))
+            }
             KeyCode::Enter => {
-                if self.contacts.is_empty() {
+                if self.peer_names.is_empty() {
                     return;
                 }
                 self.send_call = true;
@@ -118,6 +158,72 @@ impl App {
     }
 }
 
+// Keeps a snapshot of the users in the database, updated as the database streams changes to
+// them, so the UI loop never waits on the network and incoming calls are noticed right away.
+// Stops once the receiver is dropped.
+fn spawn_contacts_listener(rtdb: Arc<RTDB>) -> watch::Receiver<HashMap<String, User>> {
+    let (tx, rx) = watch::channel(HashMap::new());
+    tokio::spawn(async move {
+        // Each subscription starts with the full users tree, so resubscribing resyncs it
+        let mut tree = Value::Null;
+        // If the stream is slow to open, the users are fetched once so the menu isn't left
+        // empty. Whatever the stream delivers afterwards replaces that snapshot.
+        let fallback = tokio::time::sleep(CONTACTS_FALLBACK_DELAY);
+        tokio::pin!(fallback);
+        let mut synced = false;
+        loop {
+            let mut events = rtdb.listen("users");
+            loop {
+                let event = tokio::select! {
+                    event = events.recv() => event,
+                    _ = &mut fallback, if !synced => {
+                        synced = true;
+                        if tx.send(rtdb.get_users().await).is_err() {
+                            return;
+                        }
+                        continue;
+                    }
+                    _ = tx.closed() => return,
+                };
+                let Some(event) = event else {
+                    break;
+                };
+                synced = true;
+
+                // Apply everything that already arrived before publishing a new snapshot
+                event.apply_to(&mut tree);
+                while let Ok(event) = events.try_recv() {
+                    event.apply_to(&mut tree);
+                }
+                if tx.send(users_from_tree(&tree)).is_err() {
+                    return;
+                }
+            }
+
+            warn!("Lost the stream of users, resubscribing");
+            tokio::time::sleep(CONTACTS_RESUBSCRIBE_DELAY).await;
+        }
+    });
+    rx
+}
+
+fn users_from_tree(tree: &Value) -> HashMap<String, User> {
+    let Some(users) = tree.as_object() else {
+        return HashMap::new();
+    };
+
+    users
+        .iter()
+        .filter_map(|(name, user)| match User::deserialize(user) {
+            Ok(user) => Some((name.clone(), user)),
+            Err(e) => {
+                warn!("Ignoring malformed user {}: {}", name, e);
+                None
+            }
+        })
+        .collect()
+}
+
 impl Widget for &App {
     fn render(self, area: Rect, buf: &mut Buffer) {
         let title = Title::from(" TermCall ".bold());
@@ -142,7 +248,7 @@ impl Widget for &App {
             .padding(Padding::proportional(1));
 
         // make the contact at selected index bold
-        let cnames = self.contact_names(false);
+        let cnames = &self.peer_names;
         let contacts = cnames
             .iter()
             .enumerate()
@@ -2,7 +2,23 @@ use anyhow::Result;
 use opencv::core::Mat;
 use opencv::videoio::VideoCapture;
 use opencv::{prelude::*, videoio};
-use simple_log::error;
+use simple_log::{error, warn};
+
+// Frames the capture backend may queue up. Keeping only one means each read returns the
+// newest frame instead of one that sat in the driver's queue while we were busy.
+const CAPTURE_BUFFER_SIZE: f64 = 1.0;
+
+// Native capture backend for the target platform, picked at compile time. Opening with
+// CAP_ANY makes OpenCV try each backend it was built with until one accepts the device, so
+// it is still used when OpenCV lacks the native backend or it can't open the camera.
+#[cfg(target_os = "linux")]
+const CAPTURE_API: i32 = videoio::CAP_V4L2;
+#[cfg(target_os = "macos")]
+const CAPTURE_API: i32 = videoio::CAP_AVFOUNDATION;
+#[cfg(target_os = "windows")]
+const CAPTURE_API: i32 = videoio::CAP_DSHOW;
+#[cfg(not(any(target_os = "linux", target_os = "macos", target_os = "windows")))]
+const CAPTURE_API: i32 = videoio::CAP_ANY;
 
 pub struct Camera {
     cam: videoio::VideoCapture,
@@ -21,11 +37,28 @@ impl Camera {
         cam_fps: f64,
         cam_index: i32,
     ) -> Result<()> {
-        self.cam = videoio::VideoCapture::new(cam_index, videoio::CAP_ANY)?;
+        let native = videoio::VideoCapture::new(cam_index, CAPTURE_API)
+            .ok()
+            .filter(|cam| videoio::VideoCapture::is_opened(cam).unwrap_or(false));
+        self.cam = match native {
+            Some(cam) => cam,
+            None => {
+                warn!("Native camera backend couldn't open the camera, trying the others");
+                videoio::VideoCapture::new(cam_index, videoio::CAP_ANY)?
+            }
+        };
         self.cam.set(videoio::CAP_PROP_FRAME_WIDTH, cam_width)?;
         self.cam.set(videoio::CAP_PROP_FRAME_HEIGHT, cam_height)?;
         self.cam.set(videoio::CAP_PROP_FPS, cam_fps)?;
 
+        // not every backend supports this, in which case reads just lag a little more
+        if !self
+            .cam
+            .set(videoio::CAP_PROP_BUFFERSIZE, CAPTURE_BUFFER_SIZE)?
+        {
+            warn!("Camera backend ignored the capture buffer size");
+        }
+
         match videoio::VideoCapture::is_opened(&self.cam) {
             Ok(true) => Ok(()),
             Ok(false) => {
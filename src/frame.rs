@@ -1,19 +1,100 @@
-use crossterm::style::{Color, Print, SetBackgroundColor};
-use opencv::core::{Mat, Point3_, Size};
+use anyhow::Result;
+use opencv::core::{Mat, Point3_, Size, Vector};
 use opencv::{imgcodecs, imgproc, prelude::*};
 use simple_log::error;
 use std::io::Write;
 
 const ASCII_CHAR_H_OVER_W: f64 = 2.25;
 
+// Frames end up as a few thousand terminal cells, so the artifacts of a lower JPEG quality
+// aren't visible, while payloads get smaller and encode/decode faster
+const JPEG_QUALITY: i32 = 60;
+
+// Escape sequences for truecolor backgrounds are assembled from this table rather than
+// formatted per pixel. Each entry holds the decimal digits of a u8 and how many are used.
+const U8_DIGITS: [([u8; 3], usize); 256] = u8_digits();
+const SGR_BG_RGB: &[u8] = b"\x1b[48;2;";
+const SGR_RESET: &[u8] = b"\x1b[0m";
+
+// Unchanged cells between two changed ones are skipped with a cursor move only if there are at
+// least this many of them, which is about the length of the move's escape sequence
+const MIN_SKIPPED_CELLS: usize = 8;
+
+const fn u8_digits() -> [([u8; 3], usize); 256] {
+    let mut table = [([0u8; 3], 0usize); 256];
+    let mut i = 0;
+    while i < 256 {
+        let n = i as u8;
+        table[i] = if n >= 100 {
+            ([b'0' + n / 100, b'0' + n / 10 % 10, b'0' + n % 10], 3)
+        } else if n >= 10 {
+            ([b'0' + n / 10, b'0' + n % 10, 0], 2)
+        } else {
+            ([b'0' + n, 0, 0], 1)
+        };
+        i += 1;
+    }
+    table
+}
+
+// Appends the SGR sequence setting the background to (r, g, b)
+fn push_sgr_bg(buf: &mut Vec<u8>, r: u8, g: u8, b: u8) {
+    buf.extend_from_slice(SGR_BG_RGB);
+    for (i, channel) in [r, g, b].into_iter().enumerate() {
+        if i != 0 {
+            buf.push(b';');
+        }
+        let (digits, len) = &U8_DIGITS[channel as usize];
+        buf.extend_from_slice(&digits[..*len]);
+    }
+    buf.push(b'm');
+}
+
+// The range of source pixels (along one axis) covered by cell `i` of `cells`. When there are
+// more cells than pixels, neighbouring cells share a pixel.
+fn cell_span(i: usize, cells: usize, pixels: usize) -> (usize, usize) {
+    let start = i * pixels / cells;
+    let end = ((i + 1) * pixels / cells).max(start + 1).min(pixels);
+    (start, end)
+}
+
 pub struct Frame {
     data: Mat,
+    // Spare buffer that new images and resize/flip output are written into before being
+    // swapped with `data`. Once frame sizes settle, neither buffer has to be reallocated.
+    scratch: Mat,
+    // Encoded output of get_bytes, reused between frames so its capacity is kept
+    encoded: Vector<u8>,
+    encode_params: Vector<i32>,
+    // Cells and width of what write_to_terminal last drew, so unchanged cells can be skipped
+    drawn: Vec<Point3_<u8>>,
+    drawn_width: usize,
+    // The row of cells currently being sampled by write_to_terminal, and the source columns
+    // each cell covers (the same for every row, so they're worked out once per frame)
+    row: Vec<Point3_<u8>>,
+    columns: Vec<(usize, usize)>,
+    // Escape sequences for a whole frame are assembled here and written with a single call.
+    // Kept between frames so its capacity is reused.
+    out: Vec<u8>,
 }
 
 impl Frame {
     pub fn new() -> Frame {
         let data = Mat::default();
-        Frame { data }
+        let scratch = Mat::default();
+        let encoded = Vector::new();
+        let encode_params = Vector::from_slice(&[imgcodecs::IMWRITE_JPEG_QUALITY, JPEG_QUALITY]);
+        Frame {
+            data,
+            scratch,
+            encoded,
+            encode_params,
+            drawn: Vec::new(),
+            drawn_width: 0,
+            row: Vec::new(),
+            columns: Vec::new(),
+            out: Vec::new(),
+        }
     }
 
     pub fn get_ref(&self) -> &Mat {
@@ -24,10 +105,11 @@ impl Frame {
         &mut self.data
     }
 
-    pub fn get_bytes(&self) -> Vec<u8> {
-        let mut buf = opencv::core::Vector::new();
-        imgcodecs::imencode(".jpg", &self.data, &mut buf, &opencv::core::Vector::new()).unwrap();
-        buf.to_vec()
+    // Encodes the frame as JPEG. The returned bytes live in a buffer owned by the frame and
+    // are overwritten by the next call.
+    pub fn get_bytes(&mut self) -> &[u8] {
+        imgcodecs::imencode(".jpg", &self.data, &mut self.encoded, &self.encode_params).unwrap();
+        self.encoded.as_slice()
     }
 
     // Resizes a Mat to the specified width and height
@@ -59,17 +141,28 @@ impl Frame {
             },
         };
 
-        let frame_read = self.data.clone();
+        if self.data.size().map_or(false, |size| size == new_size) {
+            return;
+        }
+
+        // Shrinking averages each block of source pixels (like the terminal sampling does),
+        // rather than interpolating between a few of them and aliasing the rest away
+        let shrinking = new_size.width < self.data.cols() && new_size.height < self.data.rows();
+        let interpolation = if shrinking {
+            imgproc::INTER_AREA
+        } else {
+            imgproc::INTER_LINEAR
+        };
 
         match imgproc::resize(
-            &frame_read,
-            &mut self.data,
+            &self.data,
+            &mut self.scratch,
             new_size,
             0.0,
             0.0,
-            opencv::imgproc::INTER_LINEAR,
+            interpolation,
         ) {
-            Ok(_) => {}
+            Ok(_) => std::mem::swap(&mut self.data, &mut self.scratch),
             Err(e) => {
                 error!("Error resizing frame: {}", e);
             }
@@ -100,45 +193,130 @@ impl Frame {
         unsafe { self.data.set_data(data_ptr) }
     }
 
-    pub fn write_to_terminal(&mut self) {
-        let frame = self.get_frame();
-        let data = frame.data_typed::<Point3_<u8>>().unwrap();
-        let frame_width = frame.cols();
-        let frame_height = frame.rows();
-        let prev_color = Color::Rgb { r: 0, g: 0, b: 0 };
-        let mut out = std::io::stdout();
-
-        write!(out, "{}", crossterm::cursor::MoveTo(0, 0)).unwrap();
-        for (i, pixel) in data.iter().enumerate() {
-            if (i % frame_width as usize == 0) && i != 0 {
-                write!(out, "\n\r").unwrap();
+    // Draws the frame scaled to `width` x `height` cells. Each cell is the mean of the block
+    // of pixels it covers, sampled in the same pass that writes it out, so no resized copy of
+    // the image is made. Only cells that differ from the last frame drawn are rewritten, and
+    // everything is redrawn if the size changed or after invalidate. `trailer` (e.g. a status
+    // line) goes out in the same write as the frame, so a redraw costs a single syscall.
+    pub fn write_to_terminal(&mut self, width: usize, height: usize, trailer: &[u8]) {
+        // A payload that couldn't be decoded leaves an empty single-channel image behind, so
+        // the size is checked before the pixels are read as BGR
+        let (src_width, src_height) = (self.data.cols() as usize, self.data.rows() as usize);
+        if width == 0 || height == 0 || src_width == 0 || src_height == 0 {
+            return;
+        }
+        let data = match self.data.data_typed::<Point3_<u8>>() {
+            Ok(data) => data,
+            Err(e) => {
+                error!("Error reading frame pixels: {}", e);
+                return;
             }
+        };
 
-            let (b, g, r) = (pixel.x, pixel.y, pixel.z);
-            let color = Color::Rgb { r, g, b };
+        let redraw_all = self.drawn.len() != width * height || self.drawn_width != width;
+        if redraw_all {
+            self.drawn.clear();
+            self.drawn.resize(width * height, Point3_::new(0, 0, 0));
+            self.drawn_width = width;
+        }
+        self.row.resize(width, Point3_::new(0, 0, 0));
+        self.columns.clear();
+        self.columns
+            .extend((0..width).map(|x| cell_span(x, width, src_width)));
 
-            if color != prev_color {
-                crossterm::execute!(out, SetBackgroundColor(color)).unwrap();
+        let mut prev_color = None;
+        let out = &mut self.out;
+        out.clear();
+
+        for y in 0..height {
+            let (y0, y1) = cell_span(y, height, src_height);
+            for (cell, &(x0, x1)) in self.row.iter_mut().zip(&self.columns) {
+                let (mut b, mut g, mut r) = (0u32, 0u32, 0u32);
+                for sy in y0..y1 {
+                    for pixel in &data[sy * src_width + x0..sy * src_width + x1] {
+                        b += pixel.x as u32;
+                        g += pixel.y as u32;
+                        r += pixel.z as u32;
+                    }
+                }
+                let n = ((y1 - y0) * (x1 - x0)) as u32;
+                *cell = Point3_::new((b / n) as u8, (g / n) as u8, (r / n) as u8);
             }
 
-            crossterm::execute!(out, Print(" ")).unwrap();
+            // Only runs of cells that changed are rewritten. Unchanged gaps shorter than a
+            // cursor move are rewritten too, since jumping over them would cost more bytes.
+            let drawn_row = &mut self.drawn[y * width..(y + 1) * width];
+            let changed = |x: usize| redraw_all || drawn_row[x] != self.row[x];
+            let mut x = 0;
+            while x < width {
+                if !changed(x) {
+                    x += 1;
+                    continue;
+                }
+                let start = x;
+                let mut end = x + 1;
+                x = end;
+                while x < width && x - end < MIN_SKIPPED_CELLS {
+                    if changed(x) {
+                        end = x + 1;
+                    }
+                    x += 1;
+                }
+                x = end;
+
+                write!(out, "{}", crossterm::cursor::MoveTo(start as u16, y as u16)).unwrap();
+                for cell in &self.row[start..end] {
+                    let (b, g, r) = (cell.x, cell.y, cell.z);
+
+                    // only emit an escape sequence when the color actually changes
+                    if prev_color != Some((r, g, b)) {
+                        push_sgr_bg(out, r, g, b);
+                        prev_color = Some((r, g, b));
+                    }
+
+                    out.push(b' ');
+                }
+            }
+            drawn_row.copy_from_slice(&self.row);
         }
+        out.extend_from_slice(SGR_RESET);
+        out.extend_from_slice(trailer);
 
-        crossterm::execute!(out, SetBackgroundColor(Color::Reset)).unwrap();
+        let mut stdout = std::io::stdout().lock();
+        stdout.write_all(out).unwrap();
+        stdout.flush().unwrap();
+    }
+
+    // Forgets what was drawn, e.g. after the terminal was cleared, so the next frame is
+    // drawn in full
+    pub fn invalidate(&mut self) {
+        self.drawn.clear();
     }
 
     pub fn get_frame(&self) -> &Mat {
         &self.data
     }
 
-    pub fn load_bytes(&mut self, bytes: Vec<u8>) {
-        let mat = imgcodecs::imdecode(
-            &opencv::types::VectorOfu8::from(bytes),
+    // Decodes straight into the spare buffer, so once frame sizes settle no new image has to
+    // be allocated per frame
+    pub fn load_bytes(&mut self, bytes: &[u8]) {
+        imgcodecs::imdecode_to(
+            &Vector::<u8>::from_slice(bytes),
             imgcodecs::IMREAD_COLOR,
+            &mut self.scratch,
         )
         .unwrap();
 
-        self.data = mat;
+        // keep the current buffer around as the next resize destination
+        std::mem::swap(&mut self.data, &mut self.scratch);
+    }
+
+    // Lets `load` write a new image into the spare buffer, which then becomes the current frame.
+    // Unlike writing through get_mut_ref, this leaves the last resize output untouched for reuse.
+    pub fn load_with(&mut self, load: impl FnOnce(&mut Mat) -> Result<()>) -> Result<()> {
+        load(&mut self.scratch)?;
+        std::mem::swap(&mut self.data, &mut self.scratch);
+        Ok(())
     }
 
     pub fn load_mat(&mut self, mat: &Mat) {
@@ -146,8 +324,8 @@ impl Frame {
     }
 
     pub fn get_frame_mirrored(&mut self) -> &Mat {
-        let orig_frame = self.data.clone();
-        opencv::core::flip(&orig_frame, &mut self.data, 1).unwrap();
+        opencv::core::flip(&self.data, &mut self.scratch, 1).unwrap();
+        std::mem::swap(&mut self.data, &mut self.scratch);
         &self.data
     }
 
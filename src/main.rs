@@ -9,19 +9,26 @@ mod tui;
 
 use anyhow::anyhow;
 use app::App;
-use bytes::BytesMut;
+use bytes::{Bytes, BytesMut};
 use crossterm::event;
 use devices::camera::Camera;
 use frame::Frame;
+use futures::{stream::FuturesUnordered, StreamExt};
 use peer_connection::PeerConnection;
-use rtdb::RTDB;
+use rtdb::{RTDBEvent, RTDB};
 use schemas::user::User;
-use simple_log::{error, LogConfigBuilder};
+use simple_log::{error, warn, LogConfigBuilder};
 use std::{
+    collections::VecDeque,
     io::{self, Write},
     sync::{atomic, Arc},
     time::{Duration, SystemTime, UNIX_EPOCH},
 };
+use tokio::{
+    sync::{mpsc, watch},
+    time::MissedTickBehavior,
+};
+use webrtc::ice_transport::ice_candidate::RTCIceCandidateInit;
 
 // Minimum settings for camera
 const CAMERA_WIDTH: f64 = 640 as f64;
@@ -29,6 +36,22 @@ const CAMERA_HEIGHT: f64 = 480 as f64;
 const CAMERA_FPS: f64 = 30 as f64;
 const FRAME_COMPRESSION_FACTOR: f64 = 0.5;
 
+// Size of the frames that are sent
+const FRAME_WIDTH: f64 = CAMERA_WIDTH * FRAME_COMPRESSION_FACTOR;
+const FRAME_HEIGHT: f64 = CAMERA_HEIGHT * FRAME_COMPRESSION_FACTOR;
+
+// Both the sending and rendering loops are capped at 30fps
+const FRAME_INTERVAL: Duration = Duration::from_millis(1000 / 30);
+
+// How long to wait for more local ICE candidates before publishing the ones gathered so far
+const CANDIDATE_BATCH_WINDOW: Duration = Duration::from_millis(30);
+
+// Pause before resubscribing to a database stream that was dropped
+const RESUBSCRIBE_DELAY: Duration = Duration::from_millis(200);
+
+// Frames that may wait in the data channel's send buffer before new ones are skipped
+const MAX_QUEUED_FRAMES: usize = 1;
+
 fn timestamp() -> u64 {
     SystemTime::now()
         .duration_since(UNIX_EPOCH)
@@ -36,6 +59,14 @@ fn timestamp() -> u64 {
         .as_secs()
 }
 
+// Frames are stamped in milliseconds so latency can be measured at frame granularity
+fn timestamp_millis() -> u64 {
+    SystemTime::now()
+        .duration_since(UNIX_EPOCH)
+        .unwrap()
+        .as_millis() as u64
+}
+
 fn init_logging() -> anyhow::Result<(), String> {
     let config = LogConfigBuilder::builder()
         .path(&format!("./logs/{}.log", timestamp()))
@@ -52,7 +83,8 @@ fn init_logging() -> anyhow::Result<(), String> {
 #[tokio::main]
 async fn main() -> anyhow::Result<()> {
     init_logging().map_err(|e| anyhow!(e))?;
-    let rtdb = RTDB::new();
+    // One client for the whole session, so its connection pool is shared
+    let rtdb = Arc::new(RTDB::new());
 
     // ---------- Entering Name Screen ----------
     print!("Enter your name: ");
@@ -63,7 +95,7 @@ async fn main() -> anyhow::Result<()> {
 
     // ---------- Main App Loop ----------
     let mut terminal = tui::init()?;
-    App::default().run(&mut terminal, &self_name).await?;
+    App::default().run(&mut terminal, &self_name, rtdb).await?;
     tui::restore()?;
 
     Ok(())
@@ -88,8 +120,7 @@ pub async fn wait_get_unique_name(rtdb: &RTDB) -> anyhow::Result<String> {
             continue;
         }
 
-        let usernames = rtdb.get_usernames().await;
-        match usernames.contains(&self_name) {
+        match rtdb.user_exists(&self_name).await {
             true => {
                 print!("User already exists. Try entering a different name: ");
                 io::stdout().flush()?;
@@ -111,49 +142,58 @@ async fn handle_incoming_call(
 ) -> anyhow::Result<()> {
     let caller_name = caller_data.name.clone();
     println!("Answering call from {}...", caller_name);
-    let remote_offer = caller_data.offer.clone();
-    let (remote_sd, remote_candidates) =
-        serde_json::from_str(&remote_offer).expect("Remote offer should be valid JSON");
+    let remote_sd = caller_data
+        .offer
+        .clone()
+        .ok_or_else(|| anyhow!("{} is calling without an offer", caller_name))?;
+
+    let remote_candidates = rtdb.listen(&format!("users/{}/candidates", caller_name));
 
     rtc_connection
         .set_remote_description(remote_sd)
         .await
         .expect("Remote session description should be valid");
 
-    rtc_connection
-        .add_remote_ice_candidates(remote_candidates)
-        .await
-        .expect("Remote ice candidates should be valid");
-
     let sd = rtc_connection
         .create_answer()
         .await
         .expect("peer connection offer should be set");
 
-    rtc_connection
-        .set_local_description(sd.clone())
-        .await
-        .expect("Local session description should be valid");
-
-    rtc_connection.wait_ice_candidates_gathered().await;
-    let candidates = rtc_connection.get_ice_candidates().await;
-
-    let answer =
-        serde_json::to_string(&(sd, candidates)).expect("Components should be serializable");
-
-    rtdb.add_or_update_user(
-        &self_name,
-        User {
-            answer,
-            receiving_call: caller_name.to_string(),
-            ..User::new(self_name.to_string())
-        },
-    )
-    .await?;
-
-    println!("Answer sent! Waiting for connection...");
-
-    rtc_connection.wait_peer_connected().await;
+    // Candidates are trickled separately, so the answer can go out before gathering finishes.
+    // It is written while the local description is applied and candidates start flowing, so
+    // the database round trip overlaps the rest of the setup.
+    let set_local_description = async {
+        rtc_connection
+            .set_local_description(sd.clone())
+            .await
+            .expect("Local session description should be valid");
+        Ok(())
+    };
+    let publish_answer = async {
+        rtdb.add_or_update_user(
+            &self_name,
+            User {
+                answer: Some(sd.clone()),
+                receiving_call: caller_name.to_string(),
+                ..User::new(self_name.to_string())
+            },
+        )
+        .await?;
+        println!("Answer sent! Waiting for connection...");
+        Ok(())
+    };
+
+    tokio::try_join!(
+        set_local_description,
+        publish_answer,
+        exchange_ice_candidates(
+            self_name,
+            &caller_name,
+            rtdb,
+            rtc_connection,
+            remote_candidates,
+        )
+    )?;
     rtc_connection.wait_data_channels_open().await;
 
     rtdb.add_or_update_user(
@@ -180,52 +220,70 @@ async fn handle_sending_call(
     println!("Calling {}...", person_to_call);
     let sdp = rtc_connection.create_offer().await?;
 
-    rtc_connection
-        .set_local_description(sdp.clone())
-        .await
-        .expect("Local sd should be valid");
-
-    rtc_connection.wait_ice_candidates_gathered().await;
-    let candidates = rtc_connection.get_ice_candidates().await;
+    // Subscribe before sending the offer so an answer can't arrive unnoticed in between
+    let mut peer_answer = rtdb.listen(&format!("users/{}/answer", person_to_call));
+    let remote_candidates = rtdb.listen(&format!("users/{}/candidates", person_to_call));
 
-    let offer =
-        serde_json::to_string(&(sdp, candidates)).expect("Components should be serializable");
-
-    rtdb.add_or_update_user(
+    // Candidates are trickled separately, so the offer can go out before gathering finishes.
+    // It is written while the local description is applied and the answer awaited, so the
+    // database round trip overlaps the rest of the setup.
+    let publish_offer = rtdb.add_or_update_user(
         &self_name,
         User {
-            offer,
+            offer: Some(sdp.clone()),
             sending_call: person_to_call.to_string(),
             ..User::new(self_name.to_string())
         },
-    )
-    .await?;
-
-    let mut answer = String::new();
-    while answer == "" {
-        let contacts = rtdb.get_users().await;
-        answer = contacts
-            .get(person_to_call)
-            .expect("Peer data should be in rtdb")
-            .answer
-            .clone();
-        tokio::time::sleep(Duration::from_millis(500)).await;
-    }
-
-    println!("{} answered! Connecting...", person_to_call);
-    let (remote_sd, remote_candidates) =
-        serde_json::from_str(&answer).expect("Answer should be valid JSON");
-
-    rtc_connection
-        .set_remote_description(remote_sd)
-        .await
-        .expect("Remote session description should be valid");
-    rtc_connection
-        .add_remote_ice_candidates(remote_candidates)
-        .await
-        .expect("Remote ice candidates should be valid");
+    );
+
+    // Wake up as soon as the database pushes the answer, rather than polling for it
+    let wait_for_answer = async move {
+        rtc_connection
+            .set_local_description(sdp)
+            .await
+            .expect("Local sd should be valid");
+
+        let remote_sd = loop {
+            match peer_answer.recv().await {
+                Some(RTDBEvent::Put { path, data }) if path == "/" && !data.is_null() => {
+                    match serde_json::from_value(data) {
+                        Ok(answer) => break answer,
+                        Err(e) => warn!("Ignoring malformed answer from {}: {}", person_to_call, e),
+                    }
+                }
+                Some(_) => {}
+                None => {
+                    return Err(anyhow!(
+                        "Lost connection to database while waiting for {} to answer",
+                        person_to_call
+                    ))
+                }
+            }
+        };
 
-    rtc_connection.wait_peer_connected().await;
+        // Nothing else is read from the answer, so its stream isn't kept open for the call
+        drop(peer_answer);
+
+        println!("{} answered! Connecting...", person_to_call);
+        rtc_connection
+            .set_remote_description(remote_sd)
+            .await
+            .expect("Remote session description should be valid");
+        Ok(())
+    };
+
+    // Keep trickling our candidates while the callee prepares the answer
+    tokio::try_join!(
+        publish_offer,
+        wait_for_answer,
+        exchange_ice_candidates(
+            self_name,
+            person_to_call,
+            rtdb,
+            rtc_connection,
+            remote_candidates
+        )
+    )?;
     rtc_connection.wait_data_channels_open().await;
 
     rtdb.add_or_update_user(
@@ -242,14 +300,127 @@ async fn handle_sending_call(
     Ok(())
 }
 
+// ---------- Trickle ICE ----------
+// Publishes our ICE candidates as soon as they are gathered and applies the peer's as the
+// database pushes them, until the peer connection is established
+async fn exchange_ice_candidates(
+    self_name: &str,
+    peer_name: &str,
+    rtdb: &RTDB,
+    rtc_connection: &PeerConnection,
+    mut remote_candidates: mpsc::Receiver<RTDBEvent>,
+) -> anyhow::Result<()> {
+    let mut local_candidates = rtc_connection.on_candidate_rx.lock().unwrap();
+    let mut published = 0;
+
+    // Key of the newest remote candidate applied. The peer publishes its candidates under
+    // increasing keys, so anything at or below it was already seen. If the stream drops, it is
+    // resumed from this key, so only that one is delivered (and skipped) again.
+    let mut last_key: Option<String> = None;
+
+    // Publishing runs alongside the loop, so remote candidates keep being applied while a
+    // write is waiting on the database. Only one write is in flight at a time and candidates
+    // gathered meanwhile queue up behind it, so batches land in key order, which the peer
+    // relies on when skipping keys it has already seen.
+    let write_batch = |first_index: usize, batch: Vec<RTCIceCandidateInit>| async move {
+        rtdb.add_ice_candidates(self_name, first_index, &batch)
+            .await
+    };
+    let mut writing = FuturesUnordered::new();
+    let mut queued = vec![];
+
+    loop {
+        if writing.is_empty() && !queued.is_empty() {
+            let batch = std::mem::take(&mut queued);
+            let first_index = published;
+            published += batch.len();
+            writing.push(write_batch(first_index, batch));
+        }
+
+        tokio::select! {
+            _ = rtc_connection.wait_peer_connected() => return Ok(()),
+            Some(written) = writing.next() => written?,
+            Some(candidate) = local_candidates.recv() => {
+                // Candidates are gathered in bursts, so collect whatever else turns up shortly
+                // after the first one and publish them all in one write
+                queued.push(candidate);
+                let deadline = tokio::time::Instant::now() + CANDIDATE_BATCH_WINDOW;
+                while let Ok(Some(candidate)) =
+                    tokio::time::timeout_at(deadline, local_candidates.recv()).await
+                {
+                    queued.push(candidate);
+                }
+            }
+            event = remote_candidates.recv() => {
+                let Some(event) = event else {
+                    warn!("Lost the stream of {}'s ICE candidates, resubscribing", peer_name);
+                    tokio::time::sleep(RESUBSCRIBE_DELAY).await;
+                    remote_candidates = rtdb.listen_from(
+                        &format!("users/{}/candidates", peer_name),
+                        last_key.as_deref(),
+                    );
+                    continue;
+                };
+
+                // Take every event that already arrived, so the new candidates are added as
+                // one batch
+                let mut events = vec![event];
+                while let Ok(event) = remote_candidates.try_recv() {
+                    events.push(event);
+                }
+
+                let mut batch = vec![];
+                for event in events {
+                    for (key, candidate) in candidates_from_event(event, last_key.as_deref()) {
+                        last_key = Some(key);
+                        batch.push(candidate);
+                    }
+                }
+                rtc_connection.add_remote_ice_candidates(batch).await;
+            }
+        }
+    }
+}
+
+// Extracts the candidates, keyed by their name in the database and in key order, from an
+// event on a user's "candidates" location. The initial event (and any batched write) carries
+// a map of them. Candidates at or below `after` were already applied, so they are dropped
+// before being parsed again (e.g. the one a resubscription resumes from).
+fn candidates_from_event(
+    event: RTDBEvent,
+    after: Option<&str>,
+) -> Vec<(String, RTCIceCandidateInit)> {
+    let (path, data) = match event {
+        RTDBEvent::Put { path, data } => (path, data),
+        RTDBEvent::Patch { data, .. } => (String::from("/"), data),
+    };
+
+    let mut values = match data {
+        serde_json::Value::Object(map) if path == "/" => map.into_iter().collect::<Vec<_>>(),
+        serde_json::Value::Null => vec![],
+        value => vec![(path.trim_start_matches('/').to_owned(), value)],
+    };
+    values.retain(|(key, _)| after.map_or(true, |after| key.as_str() > after));
+    values.sort_by(|(a, _), (b, _)| a.cmp(b));
+
+    values
+        .into_iter()
+        .filter_map(|(key, value)| match serde_json::from_value(value) {
+            Ok(candidate) => Some((key, candidate)),
+            Err(e) => {
+                warn!("Ignoring malformed remote ICE candidate: {}", e);
+                None
+            }
+        })
+        .collect()
+}
+
 // ---------- Call Loop ----------
 async fn call_loop(rtc_connection: &PeerConnection) -> anyhow::Result<()> {
     let mut terminal = tui::init()?;
-    let mut display_frame = Frame::new();
+    let display_frame = Frame::new();
     terminal.clear()?;
 
-    let mut frame_times = vec![];
-
     let sending_bytes = Arc::new(atomic::AtomicUsize::new(0));
     let sending_bytes_read = Arc::clone(&sending_bytes);
 
@@ -259,138 +430,290 @@ async fn call_loop(rtc_connection: &PeerConnection) -> anyhow::Result<()> {
         .await
         .expect("Data channel should exist");
 
+    // ---------- Frame Capturing Thread ----------
+    // Camera reads block until the driver has the next frame, so capturing and encoding run
+    // on their own thread. Only the newest encoded frame is kept for the sending loop.
+    let (captured_tx, mut captured_rx) = watch::channel(Bytes::new());
+    std::thread::spawn(move || capture_loop(captured_tx));
+
     // ---------- Frame Sending Loop ----------
     tokio::spawn(async move {
-        let mut camera = Camera::new();
-        let mut frame = Frame::new();
-
-        match camera.init(CAMERA_WIDTH, CAMERA_HEIGHT, CAMERA_FPS, 0) {
-            Ok(_) => {}
-            Err(e) => {
-                error!("Failed initializing camera. Ending loop: {:?}", e);
-                return;
+        // Ticks are scheduled against fixed deadlines, so time spent sending doesn't
+        // accumulate as drift. If a frame overruns, the missed ticks are skipped.
+        let mut ticker = tokio::time::interval(FRAME_INTERVAL);
+        ticker.set_missed_tick_behavior(MissedTickBehavior::Skip);
+
+        // Ends once the capture thread stops
+        while captured_rx.changed().await.is_ok() {
+            let payload = captured_rx.borrow_and_update().clone();
+
+            // If earlier frames are still waiting to go out, the link isn't keeping up and
+            // this one would only queue behind them and arrive stale. It is skipped until the
+            // backlog drains.
+            let backlog = send_dc.buffered_amount().await;
+            if backlog <= payload.len() * MAX_QUEUED_FRAMES {
+                sending_bytes.store(payload.len(), atomic::Ordering::SeqCst);
+                if send_dc.send(&payload).await.is_err() {
+                    error!("Failed sending frame on data channel. Ending loop.");
+                    break;
+                }
             }
+
+            ticker.tick().await;
         }
+    });
 
-        loop {
-            let start = std::time::Instant::now();
-            let timestamp = timestamp();
+    // ---------- Frame Receiving Loop ----------
+    // Decoding and drawing run on a blocking thread so a slow terminal never holds up the
+    // runtime. Messages are handed over through a single slot that always holds the newest
+    // one, so frames that arrive while a draw is in progress replace each other instead of
+    // queueing up behind it.
+    let (latest_tx, latest_rx) = watch::channel(Bytes::new());
+    let render = tokio::task::spawn_blocking(move || {
+        render_loop(terminal, display_frame, latest_rx, sending_bytes_read)
+    });
 
-            match camera.read_frame(frame.get_mut_ref()) {
-                Ok(_) => {}
-                Err(e) => {
-                    error!("Failed reading camera frame. Ending loop: {:?}", e);
-                    break;
+    // Only this loop consumes messages, so hold the receiver for the whole call
+    let mut on_message_rx = rtc_connection.on_message_rx.lock().unwrap();
+    loop {
+        tokio::select! {
+            message = on_message_rx.recv() => match message {
+                Some(message) => {
+                    latest_tx.send_replace(message.data);
                 }
-            }
+                None => break,
+            },
+            // The render loop exited (Esc pressed or rendering failed)
+            _ = latest_tx.closed() => break,
+        }
+    }
 
-            frame.resize_frame(
-                CAMERA_WIDTH * FRAME_COMPRESSION_FACTOR,
-                CAMERA_HEIGHT * FRAME_COMPRESSION_FACTOR,
-                false,
-            );
+    drop(latest_tx);
+    render.await??;
 
-            let frame = frame.get_bytes();
-            let timestamp_bytes = timestamp.to_be_bytes();
+    Ok(())
+}
 
-            let mut payload = BytesMut::with_capacity(frame.len() + timestamp_bytes.len());
-            payload.extend_from_slice(&frame);
-            payload.extend_from_slice(&timestamp_bytes);
-            sending_bytes.store(payload.len(), atomic::Ordering::SeqCst);
+// ---------- Frame Capturing Loop ----------
+// Runs on its own thread. Captures, scales down and encodes camera frames, publishing each
+// as a payload (JPEG followed by the capture timestamp) until the sending loop goes away.
+fn capture_loop(captured: watch::Sender<Bytes>) {
+    let mut camera = Camera::new();
+    let mut frame = Frame::new();
+
+    // Ask the driver for frames at the size they're sent at, so they don't have to be scaled
+    // down on every capture. If the camera can't deliver that size, resize_frame still does.
+    match camera.init(FRAME_WIDTH, FRAME_HEIGHT, CAMERA_FPS, 0) {
+        Ok(_) => {}
+        Err(e) => {
+            error!("Failed initializing camera. Ending loop: {:?}", e);
+            return;
+        }
+    }
 
-            if send_dc.send(&payload.freeze()).await.is_err() {
-                error!("Failed sending frame on data channel. Ending loop.");
+    loop {
+        match frame.load_with(|mat| camera.read_frame(mat)) {
+            Ok(_) => {}
+            Err(e) => {
+                error!("Failed reading camera frame. Ending loop: {:?}", e);
                 break;
             }
+        }
+        let timestamp = timestamp_millis();
 
-            // Cap sending rate at 30fps
-            let elapsed = start.elapsed();
-            if elapsed < Duration::from_millis(1000 / 30) {
-                tokio::time::sleep(Duration::from_millis(1000 / 30) - elapsed).await;
-            }
+        frame.resize_frame(FRAME_WIDTH, FRAME_HEIGHT, false);
+
+        let frame = frame.get_bytes();
+        let timestamp_bytes = timestamp.to_be_bytes();
+
+        let mut payload = BytesMut::with_capacity(frame.len() + timestamp_bytes.len());
+        payload.extend_from_slice(frame);
+        payload.extend_from_slice(&timestamp_bytes);
+
+        if captured.send(payload.freeze()).is_err() {
+            break;
         }
-    });
+    }
+}
 
-    // ---------- Frame Receiving/Rendering Loop ----------
+// ---------- Frame Rendering Loop ----------
+// Runs on a blocking thread. Draws the newest frame handed over by call_loop, at most 30
+// times a second, until Esc is pressed or the call ends.
+fn render_loop(
+    mut terminal: tui::Tui,
+    mut display_frame: Frame,
+    mut latest: watch::Receiver<Bytes>,
+    sending_bytes: Arc<atomic::AtomicUsize>,
+) -> anyhow::Result<()> {
+    let runtime = tokio::runtime::Handle::current();
+    let mut frame_times = VecDeque::new();
+    let mut newest_timestamp = 0;
+    // The stats line, reused between frames
+    let mut status = Vec::new();
     let mut tsize = terminal.size()?;
+    let mut ticker = tokio::time::interval(FRAME_INTERVAL);
+    ticker.set_missed_tick_behavior(MissedTickBehavior::Skip);
     'frame_rec_loop: loop {
-        let loop_start = std::time::Instant::now();
-
-        // If Esc pressed, gracefully quit
-        if event::poll(std::time::Duration::from_millis(0)).unwrap() {
-            if let event::Event::Key(event) = event::read().unwrap() {
-                if event.code == event::KeyCode::Esc {
+        // If Esc pressed, gracefully quit. Resizes also arrive as events, so the terminal
+        // size is only re-read when it actually changes instead of on every frame.
+        while event::poll(std::time::Duration::from_millis(0)).unwrap() {
+            match event::read().unwrap() {
+                event::Event::Key(event) if event.code == event::KeyCode::Esc => {
                     break 'frame_rec_loop;
                 }
+                event::Event::Resize(width, height) => {
+                    // Clear terminal if size changed (to avoid artifacts)
+                    terminal.clear()?;
+                    display_frame.invalidate();
+                    tsize = ratatui::layout::Rect::new(0, 0, width, height);
+                }
+                _ => {}
             }
         }
 
-        // Receive payload from data channel
-        let on_message_rx = rtc_connection.on_message_rx.clone();
-        let mut on_message_rx = on_message_rx.lock().unwrap();
-        let payload = match on_message_rx.recv().await {
-            Some(payload) => Some(payload),
-            None => {
-                break 'frame_rec_loop;
-            }
-        };
+        // Wait for a new frame, giving up after a frame interval so Esc is still handled
+        // while nothing is arriving
+        match runtime.block_on(tokio::time::timeout(FRAME_INTERVAL, latest.changed())) {
+            Ok(Ok(_)) => {}
+            Ok(Err(_)) => break 'frame_rec_loop,
+            Err(_) => continue,
+        }
+        let payload = latest.borrow_and_update().clone();
 
         // Unpack payload and calculate stats
-        let payload = payload.unwrap().data;
-        let (frame, timestamp_bytes) = payload.split_at(payload.len() - 8);
+        let frame = payload.slice(..payload.len() - 8);
+        let timestamp_bytes = &payload[payload.len() - 8..];
 
         let receiving_bytes = payload.len();
         let timestamp_ = u64::from_be_bytes(timestamp_bytes.try_into().unwrap());
-        let latency = timestamp() - timestamp_;
+        let latency = timestamp_millis() as i64 - timestamp_ as i64;
 
-        // Clear terminal if size changed (to avoid artifacts)
-        if terminal.size()? != tsize {
-            terminal.clear()?;
-            tsize = terminal.size()?;
+        // Frames travel on an unordered channel, so one captured before the last frame shown
+        // can still turn up afterwards
+        if timestamp_ < newest_timestamp {
+            continue;
         }
+        newest_timestamp = timestamp_;
 
-        // Render frame to terminal
-        display_frame.load_bytes(frame.to_vec());
-        display_frame.resize_frame(tsize.width as f64, (tsize.height - 1) as f64, false);
-        display_frame.write_to_terminal();
+        // Render frame to terminal. It is scaled to fit while being drawn, so the decoded
+        // frame isn't resized first.
+        let width = tsize.width as usize;
+        let height = tsize.height.saturating_sub(1) as usize;
 
-        // Print stats
+        // Stats go at the bottom right corner if they fit
         let stats = format!(
             "latency: {:.2} s | send/recv {:.0}/{:.0} kb/s | res: {}x{} ({} pix) | fps: {}",
             latency as f64 / 1000.0,
-            sending_bytes_read.load(atomic::Ordering::SeqCst) as f64 / 1000.0,
+            sending_bytes.load(atomic::Ordering::SeqCst) as f64 / 1000.0,
             receiving_bytes as f64 / 1000.0,
-            display_frame.width(),
-            display_frame.height(),
-            display_frame.num_pixels(),
+            width,
+            height,
+            width * height,
             frame_times.len(),
         );
-
-        // Render stats at bottom right corner if string fits
+        status.clear();
         if tsize.width >= stats.len() as u16 {
             write!(
-                io::stdout(),
+                status,
                 "{}{}",
-                crossterm::cursor::MoveTo(
-                    tsize.width as u16 - stats.len() as u16,
-                    tsize.height as u16
-                ),
+                crossterm::cursor::MoveTo(tsize.width - stats.len() as u16, tsize.height),
                 stats
             )?;
-            io::stdout().flush()?;
-        };
-
-        // Cap fps to 30
-        if loop_start.elapsed() < Duration::from_millis(1000 / 30) {
-            tokio::time::sleep(Duration::from_millis(1000 / 30) - loop_start.elapsed()).await;
         }
 
-        // Calculate fps based on moving frame rate every second
-        frame_times.push(loop_start.elapsed());
-        while frame_times.iter().sum::<Duration>() >= Duration::from_secs(1) {
-            frame_times.swap_remove(0);
+        display_frame.load_bytes(&frame);
+        display_frame.write_to_terminal(width, height, &status);
+
+        // Cap fps to 30. The tick's deadline doubles as the frame's time for the fps count,
+        // so the clock isn't read again for it.
+        let frame_time = runtime.block_on(ticker.tick());
+
+        // fps is the number of frames drawn in the last second
+        frame_times.push_back(frame_time);
+        while frame_times
+            .front()
+            .map_or(false, |&t| frame_time - t >= Duration::from_secs(1))
+        {
+            frame_times.pop_front();
         }
     }
 
     Ok(())
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use serde_json::json;
+
+    fn candidate(n: u32) -> serde_json::Value {
+        json!({ "candidate": format!("candidate:{} 1 udp 1 10.0.0.1 5000 typ host", n) })
+    }
+
+    fn keys(candidates: &[(String, RTCIceCandidateInit)]) -> Vec<&str> {
+        candidates.iter().map(|(key, _)| key.as_str()).collect()
+    }
+
+    #[test]
+    fn candidates_come_out_in_key_order() {
+        let event = RTDBEvent::Put {
+            path: String::from("/"),
+            data: json!({ "c0002": candidate(2), "c0000": candidate(0), "c0001": candidate(1) }),
+        };
+        let candidates = candidates_from_event(event, None);
+
+        assert_eq!(keys(&candidates), ["c0000", "c0001", "c0002"]);
+        assert!(candidates[2].1.candidate.starts_with("candidate:2 "));
+    }
+
+    #[test]
+    fn candidates_at_or_below_the_cursor_are_skipped() {
+        let event = RTDBEvent::Put {
+            path: String::from("/"),
+            data: json!({ "c0000": candidate(0), "c0001": candidate(1), "c0002": candidate(2) }),
+        };
+        assert_eq!(
+            keys(&candidates_from_event(event, Some("c0001"))),
+            ["c0002"]
+        );
+
+        let event = RTDBEvent::Put {
+            path: String::from("/c0001"),
+            data: candidate(1),
+        };
+        assert!(candidates_from_event(event, Some("c0001")).is_empty());
+    }
+
+    #[test]
+    fn single_puts_and_patches_are_keyed_by_path() {
+        let event = RTDBEvent::Put {
+            path: String::from("/c0003"),
+            data: candidate(3),
+        };
+        assert_eq!(keys(&candidates_from_event(event, None)), ["c0003"]);
+
+        let event = RTDBEvent::Patch {
+            path: String::from("/"),
+            data: json!({ "c0005": candidate(5), "c0004": candidate(4) }),
+        };
+        assert_eq!(
+            keys(&candidates_from_event(event, None)),
+            ["c0004", "c0005"]
+        );
+    }
+
+    #[test]
+    fn deleted_and_malformed_candidates_are_ignored() {
+        let event = RTDBEvent::Put {
+            path: String::from("/"),
+            data: serde_json::Value::Null,
+        };
+        assert!(candidates_from_event(event, None).is_empty());
+
+        let event = RTDBEvent::Put {
+            path: String::from("/"),
+            data: json!({ "c0000": "not a candidate", "c0001": candidate(1) }),
+        };
+        assert_eq!(keys(&candidates_from_event(event, None)), ["c0001"]);
+    }
+}
@@ -1,36 +1,59 @@
-use std::sync::{
-    atomic::{self, AtomicBool},
-    Arc, Mutex,
-};
+use std::sync::{Arc, Mutex};
 
 use anyhow::Result;
 use simple_log::{error, info, warn};
-use tokio::sync::mpsc;
+use tokio::{
+    sync::{mpsc, watch, Notify},
+    task::JoinSet,
+};
 use webrtc::{
     api::APIBuilder,
     data_channel::{
-        data_channel_message::DataChannelMessage, data_channel_state::RTCDataChannelState,
-        RTCDataChannel,
+        data_channel_init::RTCDataChannelInit, data_channel_message::DataChannelMessage,
+        data_channel_state::RTCDataChannelState, RTCDataChannel,
     },
     ice_transport::{
         ice_candidate::{RTCIceCandidate, RTCIceCandidateInit},
         ice_server::RTCIceServer,
     },
     peer_connection::{
-        configuration::RTCConfiguration, math_rand_alpha,
+        configuration::RTCConfiguration,
+        math_rand_alpha,
         peer_connection_state::RTCPeerConnectionState,
-        sdp::session_description::RTCSessionDescription, RTCPeerConnection,
+        policy::{
+            bundle_policy::RTCBundlePolicy, ice_transport_policy::RTCIceTransportPolicy,
+            rtcp_mux_policy::RTCRtcpMuxPolicy,
+        },
+        sdp::session_description::RTCSessionDescription,
+        RTCPeerConnection,
     },
 };
 
+// Comma separated STUN urls to use instead of the default. Setting it to an empty string
+// disables STUN, so only host candidates are gathered (enough for calls on the same LAN).
+const STUN_URLS_ENV: &str = "TERMCALL_STUN_URLS";
+const DEFAULT_STUN_URL: &str = "stun:stun.l.google.com:19302";
+
+// Incoming messages kept while the renderer is busy. The renderer only draws the newest
+// one, so this just needs to be large enough that fresh frames aren't the ones dropped.
+const MESSAGE_BUFFER_SIZE: usize = 8;
+
 pub struct PeerConnection {
     pub id: String,
-    pub rtc_pc: Arc<Mutex<RTCPeerConnection>>,
-    pub candidates: Arc<Mutex<Vec<RTCIceCandidate>>>,
-    pub gathering_done: Arc<AtomicBool>,
-    pub state: Arc<Mutex<RTCPeerConnectionState>>,
+    // RTCPeerConnection is internally synchronized, so it is shared without a lock. This lets
+    // signaling steps (e.g. setting the answer and adding trickled candidates) run concurrently.
+    pub rtc_pc: Arc<RTCPeerConnection>,
+    pub on_candidate_tx: mpsc::UnboundedSender<RTCIceCandidateInit>,
+    pub on_candidate_rx: Arc<Mutex<mpsc::UnboundedReceiver<RTCIceCandidateInit>>>,
+    // Remote candidates that arrived before the remote description they belong to. Becomes
+    // None once the remote description is set and candidates can be added directly.
+    pub pending_remote_candidates: Arc<Mutex<Option<Vec<RTCIceCandidateInit>>>>,
+    // Waiters are woken on every state change and each time a data channel opens, rather
+    // than checking back on a timer
+    pub state: Arc<watch::Sender<RTCPeerConnectionState>>,
     pub data_channels: Arc<Mutex<Vec<Arc<RTCDataChannel>>>>,
-    pub on_message_tx: Arc<Mutex<mpsc::Sender<DataChannelMessage>>>,
+    pub on_dc_open: Arc<Notify>,
+    pub on_message_tx: mpsc::Sender<DataChannelMessage>,
     pub on_message_rx: Arc<Mutex<mpsc::Receiver<DataChannelMessage>>>,
     pub on_close_tx: Arc<Mutex<mpsc::Sender<()>>>,
     pub on_close_rx: Arc<Mutex<mpsc::Receiver<()>>>,
@@ -40,19 +63,22 @@ impl PeerConnection {
     pub async fn new() -> Result<Self> {
         let api = APIBuilder::default().build();
         let config = RTCConfiguration {
-            ice_servers: vec![RTCIceServer {
-                urls: vec!["stun:stun.l.google.com:19302".to_owned()],
-                ..Default::default()
-            }],
+            ice_servers: ice_servers(),
+            // Everything rides on a single transport, so only one set of candidates has to be
+            // gathered and checked and only one DTLS handshake happens during setup
+            bundle_policy: RTCBundlePolicy::MaxBundle,
+            rtcp_mux_policy: RTCRtcpMuxPolicy::Require,
+            ice_transport_policy: RTCIceTransportPolicy::All,
             ..Default::default()
         };
 
         let peer_connection = api.new_peer_connection(config).await?;
-        let peer_connection = Arc::new(Mutex::new(peer_connection));
+        let peer_connection = Arc::new(peer_connection);
 
-        let (on_message_tx, on_message_rx) = mpsc::channel(1);
+        let (on_message_tx, on_message_rx) = mpsc::channel(MESSAGE_BUFFER_SIZE);
         let (on_close_tx, on_close_rx) = mpsc::channel(1);
-        let on_message_tx = Arc::new(Mutex::new(on_message_tx));
+        let (on_candidate_tx, on_candidate_rx) = mpsc::unbounded_channel();
+        let on_candidate_rx = Arc::new(Mutex::new(on_candidate_rx));
         let on_message_rx = Arc::new(Mutex::new(on_message_rx));
         let on_close_tx = Arc::new(Mutex::new(on_close_tx));
         let on_close_rx = Arc::new(Mutex::new(on_close_rx));
@@ -62,10 +88,12 @@ impl PeerConnection {
         let mut peer_connection = Self {
             id,
             rtc_pc: peer_connection,
-            candidates: Arc::new(Mutex::new(Vec::new())),
-            gathering_done: Arc::new(AtomicBool::new(false)),
-            state: Arc::new(Mutex::new(RTCPeerConnectionState::New)),
+            on_candidate_tx,
+            on_candidate_rx,
+            pending_remote_candidates: Arc::new(Mutex::new(Some(Vec::new()))),
+            state: Arc::new(watch::channel(RTCPeerConnectionState::New).0),
             data_channels: Arc::new(Mutex::new(Vec::new())),
+            on_dc_open: Arc::new(Notify::new()),
             on_message_tx,
             on_message_rx,
             on_close_tx,
@@ -94,53 +122,59 @@ impl PeerConnection {
     }
 
     pub async fn create_offer(&self) -> Result<RTCSessionDescription> {
-        let pc = self.rtc_pc.lock().unwrap();
+        let pc = &self.rtc_pc;
         let local_sd = pc.create_offer(None).await?;
         Ok(local_sd)
     }
 
     pub async fn create_answer(&self) -> Result<RTCSessionDescription> {
-        let pc = self.rtc_pc.lock().unwrap();
+        let pc = &self.rtc_pc;
         let local_sd = pc.create_answer(None).await?;
         Ok(local_sd)
     }
 
     pub async fn set_local_description(&self, local_sd: RTCSessionDescription) -> Result<()> {
-        let pc = self.rtc_pc.lock().unwrap();
+        let pc = &self.rtc_pc;
         pc.set_local_description(local_sd).await?;
         Ok(())
     }
 
     pub async fn set_remote_description(&self, remote_sd: RTCSessionDescription) -> Result<()> {
-        let pc = self.rtc_pc.lock().unwrap();
+        let pc = &self.rtc_pc;
         pc.set_remote_description(remote_sd).await?;
-        Ok(())
-    }
 
-    pub async fn get_ice_candidates(&self) -> Vec<RTCIceCandidate> {
-        let ice_cs = self.candidates.clone();
-        let ice_cs = ice_cs.lock().unwrap();
-        ice_cs.clone()
+        // A candidate that can't be added doesn't make the description invalid, so those are
+        // only logged
+        let pending = self.pending_remote_candidates.lock().unwrap().take();
+        add_ice_candidates(pc, pending.unwrap_or_default()).await;
+        Ok(())
     }
 
-    pub async fn add_remote_ice_candidates(&self, candidates: Vec<RTCIceCandidate>) -> Result<()> {
-        let pc = self.rtc_pc.lock().unwrap();
-        for candidate in candidates.iter() {
-            let candidate_init = RTCIceCandidateInit {
-                candidate: candidate.to_json()?.candidate,
-                ..Default::default()
-            };
-            pc.add_ice_candidate(candidate_init).await?;
+    // Adds a batch of trickled remote candidates, holding on to them if the remote description
+    // they belong to hasn't been set yet
+    pub async fn add_remote_ice_candidates(&self, candidates: Vec<RTCIceCandidateInit>) {
+        if let Some(pending) = self.pending_remote_candidates.lock().unwrap().as_mut() {
+            pending.extend(candidates);
+            return;
         }
-        Ok(())
+
+        add_ice_candidates(&self.rtc_pc, candidates).await;
     }
 
     pub async fn create_data_channel(&mut self, label: &str) -> Result<()> {
-        let pc = self.rtc_pc.lock().unwrap();
+        let pc = &self.rtc_pc;
         let dcs = self.data_channels.clone();
         let mut dcs = dcs.lock().unwrap();
 
-        let dc = pc.create_data_channel(label, None).await?;
+        // Frames are only useful while they're the newest one. Losing one is better than
+        // stalling every later frame behind its retransmission, so the channel is unordered
+        // and never retransmits.
+        let options = RTCDataChannelInit {
+            ordered: Some(false),
+            max_retransmits: Some(0),
+            ..Default::default()
+        };
+        let dc = pc.create_data_channel(label, Some(options)).await?;
         dcs.push(dc.clone());
         Ok(())
     }
@@ -151,7 +185,9 @@ impl PeerConnection {
         for dc in dcs.iter() {
             let dc = dc.clone();
             let dc_label = dc.label().to_owned();
+            let on_dc_open = self.on_dc_open.clone();
             dc.on_open(Box::new(move || {
+                on_dc_open.notify_waiters();
                 Box::pin(async move {
                     info!("Data channel {} is now open", dc_label);
                 })
@@ -166,8 +202,6 @@ impl PeerConnection {
             let dc = dc.clone();
             let on_message_tx = self.on_message_tx.clone();
             dc.on_message(Box::new(move |msg: DataChannelMessage| {
-                let msg = msg.clone();
-                let on_message_tx = on_message_tx.lock().unwrap();
                 match on_message_tx.try_send(msg) {
                     Ok(_) => {}
                     Err(e) => {
@@ -179,34 +213,32 @@ impl PeerConnection {
         }
     }
 
+    // Forwards each local candidate as soon as it is gathered so it can be trickled to the peer
     pub fn register_pc_on_ice_candidates(&self) {
-        let pc = self.rtc_pc.lock().unwrap();
-        let ice_cs = self.candidates.clone();
-        let acg = self.gathering_done.clone();
+        let pc = &self.rtc_pc;
+        let on_candidate_tx = self.on_candidate_tx.clone();
         pc.on_ice_candidate(Box::new(move |c: Option<RTCIceCandidate>| {
             info!("New ICE Candidate: {:?}", c);
-            let ice_cs = ice_cs.clone();
-            let acg = acg.clone();
-            Box::pin(async move {
-                let mut ice_cs = ice_cs.lock().unwrap();
-                if let Some(c) = c {
-                    ice_cs.push(c);
-                } else {
-                    acg.store(true, atomic::Ordering::SeqCst);
-                    info!("All ICE Candidates have been gathered");
+            match c.map(|c| c.to_json()) {
+                Some(Ok(candidate)) => {
+                    if on_candidate_tx.send(candidate).is_err() {
+                        warn!("Dropping ICE candidate - nobody is signaling anymore");
+                    }
                 }
-            })
+                Some(Err(e)) => error!("Failed to serialize ICE candidate: {}", e),
+                None => info!("All ICE Candidates have been gathered"),
+            }
+            Box::pin(async move {})
         }));
     }
 
     pub fn register_pc_connection_state_change(&self) {
-        let pc = self.rtc_pc.lock().unwrap();
+        let pc = &self.rtc_pc;
         let pc_state = self.state.clone();
         let on_close_tx = self.on_close_tx.clone();
         pc.on_peer_connection_state_change(Box::new(move |state: RTCPeerConnectionState| {
             info!("Peer Connection State has changed: {state}");
-            let mut pc_state = pc_state.lock().unwrap();
-            *pc_state = state;
+            pc_state.send_replace(state);
 
             if state == RTCPeerConnectionState::Disconnected {
                 on_close_tx.lock().unwrap().try_send(()).unwrap()
@@ -216,9 +248,10 @@ impl PeerConnection {
     }
 
     pub fn register_pc_on_data_channel(&self) {
-        let pc = self.rtc_pc.lock().unwrap();
+        let pc = &self.rtc_pc;
         let dcs = self.data_channels.clone();
         let on_message_tx = self.on_message_tx.clone();
+        let on_dc_open = self.on_dc_open.clone();
         pc.on_data_channel(Box::new(move |d| {
             info!("New DataChannel Received: {} {}", d.label(), d.id());
             let mut dcs = dcs.lock().unwrap();
@@ -228,14 +261,15 @@ impl PeerConnection {
             let dc_label = dc.label().to_owned();
             let dc_label2 = dc_label.clone();
             let on_message_tx = on_message_tx.clone();
+            let on_dc_open = on_dc_open.clone();
 
             dc.on_open(Box::new(move || {
                 info!("Data channel {} is now open", dc_label);
+                on_dc_open.notify_waiters();
                 Box::pin(async move {})
             }));
 
             dc.on_message(Box::new(move |msg: DataChannelMessage| {
-                let on_message_tx = on_message_tx.lock().unwrap();
                 match on_message_tx.try_send(msg) {
                     Ok(_) => {}
                     Err(e) => {}
@@ -248,31 +282,30 @@ impl PeerConnection {
     }
 
     pub async fn wait_peer_connected(&self) {
-        let pc_state = self.state.clone();
-        while *pc_state.lock().unwrap() != RTCPeerConnectionState::Connected {
-            tokio::time::sleep(tokio::time::Duration::from_millis(100)).await;
-        }
-    }
-
-    pub async fn wait_ice_candidates_gathered(&self) {
-        while !self.gathering_done.load(atomic::Ordering::SeqCst) {
-            tokio::time::sleep(tokio::time::Duration::from_millis(100)).await;
-        }
+        let mut state = self.state.subscribe();
+        // The sender lives as long as self, so this only returns once connected
+        let _ = state
+            .wait_for(|state| *state == RTCPeerConnectionState::Connected)
+            .await;
     }
 
     pub async fn wait_data_channels_open(&self) {
-        let dcs = self.data_channels.clone();
-        let dcs = dcs.lock().unwrap();
+        let dcs = self.data_channels.lock().unwrap().clone();
 
         for dc in dcs.iter() {
-            while dc.ready_state() != RTCDataChannelState::Open {
-                tokio::time::sleep(tokio::time::Duration::from_millis(100)).await;
+            loop {
+                // Registered before checking, so an open in between isn't missed
+                let opened = self.on_dc_open.notified();
+                if dc.ready_state() == RTCDataChannelState::Open {
+                    break;
+                }
+                opened.await;
             }
         }
     }
 
     pub async fn close(&self) {
-        let pc = self.rtc_pc.lock().unwrap();
+        let pc = &self.rtc_pc;
         pc.close().await.unwrap();
     }
 
@@ -289,3 +322,44 @@ impl PeerConnection {
         None
     }
 }
+
+// Candidates don't depend on each other, so they are added concurrently instead of each one
+// waiting for the one before it. One the peer sent that can't be used is skipped, since the
+// others may still connect.
+async fn add_ice_candidates(pc: &Arc<RTCPeerConnection>, candidates: Vec<RTCIceCandidateInit>) {
+    let mut adds = JoinSet::new();
+    for candidate in candidates {
+        let pc = pc.clone();
+        adds.spawn(async move {
+            let description = candidate.candidate.clone();
+            if let Err(e) = pc.add_ice_candidate(candidate).await {
+                warn!("Skipping remote ICE candidate {}: {}", description, e);
+            }
+        });
+    }
+    while let Some(added) = adds.join_next().await {
+        if let Err(e) = added {
+            error!("Adding a remote ICE candidate failed: {}", e);
+        }
+    }
+}
+
+fn ice_servers() -> Vec<RTCIceServer> {
+    let urls = match std::env::var(STUN_URLS_ENV) {
+        Ok(urls) => urls
+            .split(',')
+            .map(str::trim)
+            .filter(|url| !url.is_empty())
+            .map(str::to_owned)
+            .collect::<Vec<String>>(),
+        Err(_) => vec![DEFAULT_STUN_URL.to_owned()],
+    };
+
+    if urls.is_empty() {
+        return vec![];
+    }
+    vec![RTCIceServer {
+        urls,
+        ..Default::default()
+    }]
+}
@@ -1,29 +1,87 @@
 use crate::schemas::user::User;
 use anyhow::Result;
-use firebase_rs::Firebase;
+use rand::Rng;
+use reqwest::{header::ACCEPT, Client, RequestBuilder, Response};
+use serde::{de::DeserializeOwned, Deserialize, Serialize};
+use serde_json::Value;
 use simple_log::{error, warn};
-use std::collections::HashMap;
+use std::{collections::HashMap, time::Duration};
+use tokio::sync::mpsc;
+use webrtc::ice_transport::ice_candidate::RTCIceCandidateInit;
 
-pub const DATABASE_URL: &str = "https://termcall-a14ab-default-rtdb.firebaseio.com/.json";
+pub const DATABASE_URL: &str = "https://termcall-a14ab-default-rtdb.firebaseio.com";
+
+// Connection pool settings. Idle connections are kept warm for a while so that signaling
+// bursts during call setup don't pay for new TCP and TLS handshakes.
+const POOL_MAX_IDLE_PER_HOST: usize = 16;
+const POOL_IDLE_TIMEOUT: Duration = Duration::from_secs(300);
+const TCP_KEEPALIVE: Duration = Duration::from_secs(60);
+const CONNECT_TIMEOUT: Duration = Duration::from_secs(1);
+const REQUEST_TIMEOUT: Duration = Duration::from_secs(5);
+
+// Requests that fail transiently are retried with decorrelated jitter: each delay is drawn
+// between the base and three times the previous delay, capped. Clients that failed at the
+// same moment then spread out instead of retrying in lockstep.
+const MAX_RETRIES: u32 = 2;
+const RETRY_BACKOFF: Duration = Duration::from_millis(200);
+const RETRY_BACKOFF_CAP: Duration = Duration::from_secs(2);
+
+// Events a listener can hold before the streaming task waits for them to be consumed
+const LISTEN_BUFFER_SIZE: usize = 32;
+
+// A change streamed from a location being listened to. Paths are relative to that location.
+#[derive(Debug, PartialEq)]
+pub enum RTDBEvent {
+    // `data` replaces whatever is at `path`
+    Put { path: String, data: Value },
+    // Each key of `data` is a child of `path` to replace
+    Patch { path: String, data: Value },
+}
+
+impl RTDBEvent {
+    // Applies this change to `tree`, a local copy of the data at the location being listened to
+    pub fn apply_to(self, tree: &mut Value) {
+        match self {
+            RTDBEvent::Put { path, data } => set_path(tree, &path, data),
+            RTDBEvent::Patch { path, data } => {
+                if let Value::Object(children) = data {
+                    for (child, value) in children {
+                        set_path(tree, &format!("{}/{}", path, child), value);
+                    }
+                }
+            }
+        }
+    }
+}
+
+#[derive(Deserialize)]
+struct EventData {
+    path: String,
+    data: Value,
+}
 
 pub struct RTDB {
-    firebase: Firebase,
+    // Shared by every request so the pooled connection (and its TLS session) to the database
+    // is reused, rather than handshaking again for each read and write
+    client: Client,
 }
 
 impl RTDB {
     pub fn new() -> RTDB {
-        let firebase = Firebase::new(DATABASE_URL).unwrap();
-        RTDB { firebase }
+        let client = Client::builder()
+            .pool_max_idle_per_host(POOL_MAX_IDLE_PER_HOST)
+            .pool_idle_timeout(POOL_IDLE_TIMEOUT)
+            .tcp_keepalive(TCP_KEEPALIVE)
+            .connect_timeout(CONNECT_TIMEOUT)
+            .build()
+            .unwrap();
+
+        RTDB { client }
     }
 
     pub async fn get_users(&self) -> HashMap<String, User> {
-        match self
-            .firebase
-            .at("users")
-            .get::<HashMap<String, User>>()
-            .await
-        {
-            Ok(users) => users,
+        match self.get::<Option<HashMap<String, User>>>("users").await {
+            Ok(users) => users.unwrap_or_default(),
             Err(_) => {
                 warn!("Could not get users from database. Assuming no users and returning empty hashmap.");
                 HashMap::new()
@@ -31,19 +89,37 @@ impl RTDB {
         }
     }
 
-    pub async fn get_usernames(&self) -> Vec<String> {
-        let users = self.get_users().await;
-        users.keys().cloned().collect()
-    }
-
-    pub async fn add_or_update_user(&self, username: &str, new_data: User) -> Result<()> {
+    // Looks up a single user's name instead of downloading every user to search through
+    pub async fn user_exists(&self, username: &str) -> bool {
         match self
-            .firebase
-            .at("users")
-            .at(username)
-            .update(&new_data)
+            .get::<Option<String>>(&format!("users/{}/name", username))
             .await
         {
+            Ok(name) => name.is_some(),
+            Err(_) => {
+                warn!(
+                    "Could not look up user {}. Assuming they don't exist.",
+                    username
+                );
+                false
+            }
+        }
+    }
+
+    // Writes the fields of `new_data` together in one request
+    pub async fn add_or_update_user(&self, username: &str, new_data: User) -> Result<()> {
+        let updates = match serde_json::to_value(&new_data) {
+            Ok(Value::Object(fields)) => fields
+                .into_iter()
+                .map(|(field, value)| (format!("users/{}/{}", username, field), value))
+                .collect::<HashMap<_, _>>(),
+            _ => {
+                error!("could not serialize user {}", username);
+                return Err(anyhow::anyhow!("could not serialize user {}", username));
+            }
+        };
+
+        match self.multi_update(&updates).await {
             Ok(_) => Ok(()),
             Err(_) => {
                 error!("could not update user {}", username);
@@ -53,11 +129,360 @@ impl RTDB {
     }
 
     pub async fn remove_user(&self, username: &str) {
-        match self.firebase.at("users").at(username).delete().await {
-            Ok(_) => {}
-            Err(_) => {
-                error!("could not delete user {}", username);
+        let updates = HashMap::from([(format!("users/{}", username), Value::Null)]);
+        if self.multi_update(&updates).await.is_err() {
+            error!("could not delete user {}", username);
+        }
+    }
+
+    // Applies every update in one PATCH at the database root. Keys are paths from the root
+    // and a null value deletes that path. The database applies them all or none of them.
+    pub async fn multi_update(&self, updates: &HashMap<String, Value>) -> Result<()> {
+        self.patch("", updates).await
+    }
+
+    // Publishes a batch of our ICE candidates under users/<username>/candidates in one request
+    // for the peer to pick up. Keys are derived from each candidate's index, so retried writes
+    // are harmless.
+    pub async fn add_ice_candidates(
+        &self,
+        username: &str,
+        first_index: usize,
+        candidates: &[RTCIceCandidateInit],
+    ) -> Result<()> {
+        let mut updates = HashMap::new();
+        for (i, candidate) in candidates.iter().enumerate() {
+            let path = format!("users/{}/candidates/c{:04}", username, first_index + i);
+            updates.insert(path, serde_json::to_value(candidate)?);
+        }
+        self.multi_update(&updates).await
+    }
+
+    // Subscribes to changes at `path` using the REST streaming API. The first event is a Put
+    // of the current value at "/", followed by every change made after that. The stream ends
+    // if the connection drops, the database cancels it, or the receiver is dropped.
+    pub fn listen(&self, path: &str) -> mpsc::Receiver<RTDBEvent> {
+        self.listen_from(path, None)
+    }
+
+    // Same as listen, but when `start_key` is given only children whose keys sort at or after
+    // it are included. Used to resume a dropped stream without downloading what was seen.
+    pub fn listen_from(&self, path: &str, start_key: Option<&str>) -> mpsc::Receiver<RTDBEvent> {
+        let (tx, rx) = mpsc::channel(LISTEN_BUFFER_SIZE);
+        let mut request = self
+            .client
+            .get(Self::url(path))
+            .header(ACCEPT, "text/event-stream");
+        if let Some(key) = start_key {
+            request = request.query(&[
+                ("orderBy", String::from("\"$key\"")),
+                ("startAt", format!("\"{}\"", key)),
+            ]);
+        }
+        let path = path.to_owned();
+
+        tokio::spawn(async move {
+            let mut response = match request.send().await.and_then(|r| r.error_for_status()) {
+                Ok(response) => response,
+                Err(e) => {
+                    error!("could not listen to {}: {}", path, e);
+                    return;
+                }
+            };
+
+            let mut buf = Vec::new();
+            loop {
+                // Stop as soon as the receiver is dropped, rather than only once an event
+                // comes in that can't be delivered
+                let chunk = tokio::select! {
+                    chunk = response.chunk() => chunk,
+                    _ = tx.closed() => return,
+                };
+                match chunk {
+                    Ok(Some(chunk)) => buf.extend_from_slice(&chunk),
+                    Ok(None) => break,
+                    Err(e) => {
+                        warn!("stream for {} closed: {}", path, e);
+                        break;
+                    }
+                }
+
+                while let Some(block) = next_sse_block(&mut buf) {
+                    let event = match decode_sse_block(&block) {
+                        Ok(StreamItem::Event(event)) => event,
+                        Ok(StreamItem::KeepAlive) => continue,
+                        Ok(StreamItem::Cancelled) => {
+                            warn!("stream for {} was cancelled by the database", path);
+                            return;
+                        }
+                        Err(e) => {
+                            warn!("malformed event for {}: {}", path, e);
+                            continue;
+                        }
+                    };
+
+                    if tx.send(event).await.is_err() {
+                        return;
+                    }
+                }
+            }
+        });
+
+        rx
+    }
+
+    // ---------- REST Requests ----------
+    fn url(path: &str) -> String {
+        format!("{}/{}.json", DATABASE_URL, path)
+    }
+
+    // Sends the request built by `build`, retrying timeouts, connection failures and server
+    // errors. Only used for GET and PATCH, which are both safe to repeat.
+    async fn send(&self, build: impl Fn() -> RequestBuilder) -> Result<Response> {
+        let mut attempt = 0;
+        let mut backoff = RETRY_BACKOFF;
+        loop {
+            let result = build()
+                .timeout(REQUEST_TIMEOUT)
+                .send()
+                .await
+                .and_then(|response| response.error_for_status());
+
+            match result {
+                Err(e) if attempt < MAX_RETRIES && is_transient(&e) => {
+                    attempt += 1;
+                    warn!(
+                        "RTDB request failed, retrying ({}/{}): {}",
+                        attempt, MAX_RETRIES, e
+                    );
+                    backoff = rand::thread_rng()
+                        .gen_range(RETRY_BACKOFF..=backoff * 3)
+                        .min(RETRY_BACKOFF_CAP);
+                    tokio::time::sleep(backoff).await;
+                }
+                result => return Ok(result?),
             }
         }
     }
+
+    async fn get<T: DeserializeOwned>(&self, path: &str) -> Result<T> {
+        let response = self.send(|| self.client.get(Self::url(path))).await?;
+        Ok(response.json::<T>().await?)
+    }
+
+    async fn patch<T: Serialize + ?Sized>(&self, path: &str, data: &T) -> Result<()> {
+        self.send(|| self.client.patch(Self::url(path)).json(data))
+            .await?;
+        Ok(())
+    }
+}
+
+fn is_transient(e: &reqwest::Error) -> bool {
+    e.is_timeout() || e.is_connect() || e.status().map_or(false, |s| s.is_server_error())
+}
+
+// What a block of the event stream amounts to
+#[derive(Debug, PartialEq)]
+enum StreamItem {
+    Event(RTDBEvent),
+    KeepAlive,
+    Cancelled,
+}
+
+// Removes the first complete event from `buf` and returns it. Events are separated by a
+// blank line and may be split across chunks, so an incomplete one is left for the next chunk.
+fn next_sse_block(buf: &mut Vec<u8>) -> Option<String> {
+    let end = buf.windows(2).position(|w| w == b"\n\n")?;
+    let block = buf.drain(..end + 2).collect::<Vec<u8>>();
+    Some(String::from_utf8_lossy(&block).into_owned())
+}
+
+fn decode_sse_block(block: &str) -> serde_json::Result<StreamItem> {
+    let (kind, data) = parse_sse(block);
+    Ok(match kind {
+        "put" => {
+            let EventData { path, data } = serde_json::from_str(data)?;
+            StreamItem::Event(RTDBEvent::Put { path, data })
+        }
+        "patch" => {
+            let EventData { path, data } = serde_json::from_str(data)?;
+            StreamItem::Event(RTDBEvent::Patch { path, data })
+        }
+        "cancel" | "auth_revoked" => StreamItem::Cancelled,
+        _ => StreamItem::KeepAlive,
+    })
+}
+
+// Splits a server-sent event block into its event name and data
+fn parse_sse(block: &str) -> (&str, &str) {
+    let (mut kind, mut data) = ("", "");
+    for line in block.lines() {
+        if let Some(value) = line.strip_prefix("event:") {
+            kind = value.trim();
+        } else if let Some(value) = line.strip_prefix("data:") {
+            data = value.trim();
+        }
+    }
+    (kind, data)
+}
+
+// Writes `value` at the slash separated `path` below `tree`, creating objects along the way.
+// A null value removes the entry, as it does in the database.
+fn set_path(tree: &mut Value, path: &str, value: Value) {
+    let keys = path
+        .split('/')
+        .filter(|key| !key.is_empty())
+        .collect::<Vec<&str>>();
+    let Some((last, parents)) = keys.split_last() else {
+        *tree = value;
+        return;
+    };
+
+    // Deleting something that isn't there is a no-op, so nothing is created on the way to it
+    let mut node = tree;
+    for key in parents {
+        if !node.is_object() {
+            if value.is_null() {
+                return;
+            }
+            *node = Value::Object(Default::default());
+        }
+        let children = node.as_object_mut().unwrap();
+        if value.is_null() && !children.contains_key(*key) {
+            return;
+        }
+        node = children.entry(*key).or_insert(Value::Null);
+    }
+
+    if !node.is_object() {
+        if value.is_null() {
+            return;
+        }
+        *node = Value::Object(Default::default());
+    }
+    let children = node.as_object_mut().unwrap();
+    if value.is_null() {
+        children.remove(*last);
+    } else {
+        children.insert(last.to_string(), value);
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use serde_json::json;
+
+    fn put(path: &str, data: Value) -> StreamItem {
+        StreamItem::Event(RTDBEvent::Put {
+            path: path.to_owned(),
+            data,
+        })
+    }
+
+    #[test]
+    fn sse_blocks_are_reassembled_across_chunks() {
+        let mut buf = Vec::new();
+        buf.extend_from_slice(b"event: put\ndata: {\"path\":\"/\",");
+        assert_eq!(next_sse_block(&mut buf), None);
+
+        buf.extend_from_slice(b"\"data\":1}\n\nevent: keep-alive\n");
+        let block = next_sse_block(&mut buf).unwrap();
+        assert_eq!(decode_sse_block(&block).unwrap(), put("/", json!(1)));
+
+        // The start of the next event stays buffered until it is complete
+        assert_eq!(next_sse_block(&mut buf), None);
+        buf.extend_from_slice(b"data: null\n\n");
+        let block = next_sse_block(&mut buf).unwrap();
+        assert_eq!(decode_sse_block(&block).unwrap(), StreamItem::KeepAlive);
+        assert!(buf.is_empty());
+    }
+
+    #[test]
+    fn sse_blocks_are_decoded_by_kind() {
+        assert_eq!(
+            decode_sse_block("event: patch\ndata: {\"path\":\"/a\",\"data\":{\"b\":2}}\n\n")
+                .unwrap(),
+            StreamItem::Event(RTDBEvent::Patch {
+                path: String::from("/a"),
+                data: json!({"b": 2}),
+            })
+        );
+        assert_eq!(
+            decode_sse_block("event: keep-alive\ndata: null\n\n").unwrap(),
+            StreamItem::KeepAlive
+        );
+        assert_eq!(
+            decode_sse_block("event: cancel\ndata: null\n\n").unwrap(),
+            StreamItem::Cancelled
+        );
+        assert_eq!(
+            decode_sse_block("event: auth_revoked\ndata: null\n\n").unwrap(),
+            StreamItem::Cancelled
+        );
+        assert!(decode_sse_block("event: put\ndata: {\"path\":\n\n").is_err());
+    }
+
+    #[test]
+    fn put_replaces_and_creates_nested_paths() {
+        let mut tree = Value::Null;
+        RTDBEvent::Put {
+            path: String::from("/"),
+            data: json!({"alice": {"name": "alice"}}),
+        }
+        .apply_to(&mut tree);
+        RTDBEvent::Put {
+            path: String::from("/bob/candidates/c0000"),
+            data: json!("x"),
+        }
+        .apply_to(&mut tree);
+        RTDBEvent::Put {
+            path: String::from("/alice/name"),
+            data: json!("alice2"),
+        }
+        .apply_to(&mut tree);
+
+        assert_eq!(
+            tree,
+            json!({"alice": {"name": "alice2"}, "bob": {"candidates": {"c0000": "x"}}})
+        );
+    }
+
+    #[test]
+    fn null_deletes_the_entry() {
+        let mut tree = json!({"alice": {"name": "alice", "offer": "o"}, "bob": {"name": "bob"}});
+        RTDBEvent::Put {
+            path: String::from("/alice/offer"),
+            data: Value::Null,
+        }
+        .apply_to(&mut tree);
+        RTDBEvent::Put {
+            path: String::from("/bob"),
+            data: Value::Null,
+        }
+        .apply_to(&mut tree);
+        // Deleting below something that doesn't exist leaves the tree alone
+        RTDBEvent::Put {
+            path: String::from("/carol/name"),
+            data: Value::Null,
+        }
+        .apply_to(&mut tree);
+
+        assert_eq!(tree, json!({"alice": {"name": "alice"}}));
+    }
+
+    #[test]
+    fn patch_replaces_each_child() {
+        let mut tree = json!({"alice": {"name": "alice", "offer": "o", "in_call": ""}});
+        RTDBEvent::Patch {
+            path: String::from("/alice"),
+            data: json!({"offer": null, "in_call": "bob", "answer": "a"}),
+        }
+        .apply_to(&mut tree);
+
+        assert_eq!(
+            tree,
+            json!({"alice": {"name": "alice", "in_call": "bob", "answer": "a"}})
+        );
+    }
 }
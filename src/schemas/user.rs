@@ -1,10 +1,13 @@
 use serde::{Deserialize, Serialize};
+use webrtc::peer_connection::sdp::session_description::RTCSessionDescription;
 
-#[derive(Serialize, Deserialize, Debug)]
+#[derive(Serialize, Deserialize, Debug, Clone)]
 pub struct User {
     pub name: String,
-    pub offer: String,
-    pub answer: String,
+    // Stored as JSON objects rather than strings of JSON, so they are only parsed once.
+    // Writing None clears them in the database.
+    pub offer: Option<RTCSessionDescription>,
+    pub answer: Option<RTCSessionDescription>,
     pub in_call: String,
     pub sending_call: String,
     pub receiving_call: String,
@@ -14,8 +17,8 @@ impl User {
     pub fn new(name: String) -> User {
         User {
             name,
-            offer: String::new(),
-            answer: String::new(),
+            offer: None,
+            answer: None,
             in_call: String::new(),
             sending_call: String::new(),
             receiving_call: String::new(),